@@ -1,16 +1,19 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import Response
 from PIL import Image
-import pytesseract
-from pytesseract import TesseractError
+from tesserocr import PyTessBaseAPI, PSM
 import cv2
 import numpy as np
-from deskew import determine_skew
+import hashlib
 import io
 import logging
 import os
+import queue
+import threading
 import time
-from deskew import determine_skew
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("image-rotator")
@@ -19,42 +22,298 @@ app = FastAPI(title="Image Rotation Fixer")
 
 MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 10 * 1024 * 1024))
 MAX_DIMENSION = 2000
+SKEW_DIMENSION = 800
+MAX_SKEW_ANGLE = 10
+SKEW_COARSE_STEP = 1.0
+SKEW_FINE_STEP = 0.1
+# Dispersión mínima del perfil de bordes para aceptar un ángulo. Páginas con
+# texto o tablas dan 40 o más; ruido, fotos y manchas sueltas, menos de 6
+SKEW_MIN_DISPERSION = 10
+DETECTION_CACHE_SIZE = 128
+# Núcleos disponibles para el proceso (lo mismo que cuenta nproc en entrypoint.sh)
+# repartidos entre los WORKERS procesos uvicorn
+CPU_CORES = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+WORKERS = int(os.environ.get('WORKERS', 1))
+DETECTION_CONCURRENCY = max(1, int(os.environ.get('DETECTION_CONCURRENCY', CPU_CORES // WORKERS)))
 
+# Giros de página antihorarios como transposiciones sin interpolación
+PAGE_TRANSPOSE = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
 
-def detect_table_angle(image_array):
+# Como mucho DETECTION_CONCURRENCY detecciones a la vez por worker: cada una
+# usa una instancia de Tesseract (~32 MB) y compite por los mismos núcleos,
+# aunque el threadpool de FastAPI atienda muchas más peticiones
+_detection_slots = threading.BoundedSemaphore(DETECTION_CONCURRENCY)
+
+# Instancias de Tesseract libres. PyTessBaseAPI no es thread-safe: cada una
+# la usa un solo hilo a la vez
+_osd_pool = queue.SimpleQueue()
+
+# Hilos para deskew: OpenCV libera el GIL y se solapa con OSD. Basta uno por
+# detección simultánea
+_skew_executor = ThreadPoolExecutor(max_workers=DETECTION_CONCURRENCY)
+
+# Resultados de detect_rotation por hash de la imagen subida (LRU)
+_detection_cache = OrderedDict()
+_detection_lock = threading.Lock()
+
+
+@contextmanager
+def _osd_api():
     """
-    Detecta el ángulo de rotación usando la librería deskew.
-    Retorna el ángulo en grados para corregir.
-    Retorna None si no se puede detectar.
+    Presta una instancia de Tesseract (solo OSD) del pool, creándola si no hay
+    ninguna libre. Se reutilizan: ni subprocesos ni recarga del modelo por llamada.
+    Como solo se usa dentro de _detection_slots, nunca hay más de
+    DETECTION_CONCURRENCY instancias.
     """
     try:
-        # Convertir a escala de grises si es necesario
-        if len(image_array.shape) == 3:
-            gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+        api = _osd_pool.get_nowait()
+    except queue.Empty:
+        api = PyTessBaseAPI(lang='osd', psm=PSM.OSD_ONLY)
+    try:
+        yield api
+    finally:
+        _osd_pool.put(api)
+
+
+def detect_page_rotation(image):
+    """
+    Detecta la orientación de página (0°, 90°, 180°, 270°) con OSD de Tesseract.
+    Retorna (rotación, confianza), con la rotación en el mismo signo que
+    usa Image.rotate para enderezar la página.
+    Retorna None si OSD no puede determinarla.
+    """
+    with _osd_api() as api:
+        api.SetImage(image)
+        osd = api.DetectOrientationScript()
+    if not osd:
+        return None
+    
+    # orient_deg es el giro horario detectado; el 'Rotate:' del CLI es su complementario
+    rotate = (360 - osd['orient_deg']) % 360
+    return -rotate, osd['orient_conf']
+
+
+def load_working_image(source, max_dimension):
+    """
+    Abre la imagen en escala de grises, reducida para que su lado mayor
+    no supere max_dimension.
+    Con JPEG, draft() decodifica directamente en gris a 1/2, 1/4 o 1/8 de
+    la resolución, sin pasar por la imagen completa.
+    """
+    source.seek(0)
+    image = Image.open(source)
+    image.draft('L', (max_dimension, max_dimension))
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    return image.convert('L')
+
+
+def _best_projection_angle(edges, angles):
+    """
+    Gira los bordes a cada ángulo candidato y retorna el que maximiza la
+    dispersión (varianza / media) de las sumas por filas o por columnas: con las
+    líneas de texto o de tabla alineadas a los ejes, el perfil alterna picos y
+    huecos. Retorna (ángulo, dispersión), con la dispersión en píxeles de borde.
+    """
+    h, w = edges.shape
+    center = (w / 2, h / 2)
+    best_angle, best_score = 0.0, 0.0
+    for angle in angles:
+        matrix = cv2.getRotationMatrix2D(center, float(angle), 1.0)
+        rotated = cv2.warpAffine(edges, matrix, (w, h), flags=cv2.INTER_NEAREST)
+        rows = cv2.reduce(rotated, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+        cols = cv2.reduce(rotated, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+        if not rows.any():
+            continue
+        score = max(rows.var() / rows.mean(), cols.var() / cols.mean()) / 255
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle, best_score
+
+
+def detect_table_angle(gray):
+    """
+    Detecta el ángulo de inclinación barriendo ±MAX_SKEW_ANGLE sobre los
+    bordes de Canny de una versión reducida: primero cada SKEW_COARSE_STEP
+    grados y después cada SKEW_FINE_STEP alrededor del mejor.
+    Recibe un array 2-D en escala de grises (imagen en modo 'L').
+    Retorna el ángulo en grados para corregir.
+    Retorna None si no hay bordes con los que estimarlo o si ningún ángulo
+    los alinea mejor que bordes repartidos al azar (ruido, fotos, manchas).
+    Los errores se propagan: detect_rotation los registra y no memoiza el resultado.
+    """
+    # Reducir a SKEW_DIMENSION: la inclinación no depende de la escala.
+    # Primero a mitades con pyrDown y después un resize por el resto
+    while max(gray.shape) >= 2 * SKEW_DIMENSION:
+        gray = cv2.pyrDown(gray)
+    if max(gray.shape) > SKEW_DIMENSION:
+        scale = SKEW_DIMENSION / max(gray.shape)
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    
+    edges = cv2.Canny(gray, 50, 150)
+    angle = None
+    if edges.any():
+        # Barrido grueso a media resolución, fino a resolución completa
+        coarse = np.arange(-MAX_SKEW_ANGLE, MAX_SKEW_ANGLE + SKEW_COARSE_STEP / 2, SKEW_COARSE_STEP)
+        coarse_angle, dispersion = _best_projection_angle(cv2.Canny(cv2.pyrDown(gray), 50, 150), coarse)
+        if dispersion < SKEW_MIN_DISPERSION:
+            logger.info(f"Deskew: Flat projection profile (dispersion {dispersion:.1f})")
         else:
-            gray = image_array
-        
-        # Detectar ángulo usando deskew
-        angle = determine_skew(gray)
-        
-        if angle is None or np.isnan(angle):
-            logger.info("Deskew: Could not determine skew angle")
-            return None
-        
-        logger.info(f"Deskew detected angle: {angle:.2f}°")
-        
-        # Solo corregir si hay desviación significativa (>0.2°)
-        if abs(angle) > 0.2:
-            # deskew devuelve el ángulo de inclinación
-            # Necesitamos rotar en sentido contrario, pero primero probamos SIN negar
-            return angle
-        
-        logger.info(f"Angle too small ({angle:.2f}°), no correction needed")
-        return 0
+            low = max(coarse_angle - SKEW_COARSE_STEP / 2, -MAX_SKEW_ANGLE)
+            high = min(coarse_angle + SKEW_COARSE_STEP / 2, MAX_SKEW_ANGLE)
+            fine = np.arange(low, high + SKEW_FINE_STEP / 2, SKEW_FINE_STEP)
+            angle, _ = _best_projection_angle(edges, fine)
+    
+    if angle is None:
+        logger.info("Deskew: Could not determine skew angle")
+        return None
+    
+    logger.info(f"Deskew detected angle: {angle:.2f}°")
+    
+    # Solo corregir si hay desviación significativa (>0.2°)
+    if abs(angle) > 0.2:
+        return angle
+    
+    logger.info(f"Angle too small ({angle:.2f}°), no correction needed")
+    return 0
+
+
+def detect_rotation(source):
+    """
+    Detecta la orientación de página con OSD y la inclinación fina con deskew.
+    Retorna (osd, ángulo de deskew): osd es (rotación, confianza) o None.
+    El resultado se memoiza por hash del contenido, así que subir la misma
+    imagen otra vez no repite OSD ni deskew.
+    """
+    source.seek(0)
+    key = hashlib.file_digest(source, 'blake2b').digest()
+    with _detection_lock:
+        if key in _detection_cache:
+            _detection_cache.move_to_end(key)
+            logger.info("Detection cache hit")
+            return _detection_cache[key]
+    
+    with _detection_slots:
+        result, failed = _run_detection(source)
+    
+    # Los fallos pueden ser transitorios: solo se memoizan resultados completos
+    if not failed:
+        with _detection_lock:
+            _detection_cache[key] = result
+            if len(_detection_cache) > DETECTION_CACHE_SIZE:
+                _detection_cache.popitem(last=False)
+    return result
+
+
+def _run_detection(source):
+    """
+    Ejecuta OSD y deskew sobre la imagen de trabajo.
+    Retorna ((osd, ángulo de deskew), failed), con failed a True si alguno
+    de los dos pasos lanzó una excepción.
+    """
+    failed = False
+    
+    # Imagen de trabajo: escala de grises y reducida a MAX_DIMENSION al
+    # decodificar. A menos resolución OSD se equivoca con confianza alta;
+    # deskew la reduce después a SKEW_DIMENSION por su cuenta
+    work_image = load_working_image(source, MAX_DIMENSION)
+    
+    # Deskew en paralelo con OSD: la inclinación es la misma con la página
+    # girada 90°, 180° o 270°, así que no hace falta esperar a la orientación
+    skew_future = _skew_executor.submit(detect_table_angle, np.asarray(work_image))
+    
+    # PASO 1: Detectar orientación de página (90°, 180°, 270°) con OCR
+    osd = None
+    try:
+        osd_start = time.time()
+        osd = detect_page_rotation(work_image)
+        osd_time = time.time() - osd_start
         
+        if osd is None:
+            logger.info(f"OCR could not determine page rotation in {osd_time:.2f}s")
+        else:
+            logger.info(f"OCR page rotation: {osd[0]}° "
+                       f"(confidence {osd[1]:.2f}) in {osd_time:.2f}s")
+            
+    except Exception as e:
+        failed = True
+        logger.warning(f"OCR detection failed: {str(e)[:100]}")
+    
+    # PASO 2: Detectar inclinación fina con deskew
+    table_angle = None
+    try:
+        table_angle = skew_future.result()
     except Exception as e:
+        failed = True
         logger.warning(f"Deskew detection failed: {str(e)}")
-        return None
+    
+    return (osd, table_angle), failed
+
+
+def process_image(source, force_table_fix=False):
+    """
+    Detecta y corrige la rotación de una imagen con tablas o texto.
+    Primero corrige orientación de página (90°, 180°, 270°),
+    luego corrige inclinación fina de tabla.
+    
+    Args:
+        source: Archivo (binario, con seek) con la imagen
+        force_table_fix: Si es True, aplica corrección de tabla incluso con variación alta
+    
+    Retorna (imagen corregida, diagnóstico). La imagen es None si no hace
+    falta ninguna corrección.
+    """
+    # Abrir imagen
+    image = Image.open(source)
+    original_format = image.format or 'PNG'
+    logger.info(f"Image size: {image.size}, format: {original_format}")
+    
+    page_rotation = 0
+    fine_rotation = 0
+    detection_method = "none"
+    
+    osd, table_angle = detect_rotation(source)
+    if osd is not None:
+        page_rotation = osd[0]
+        detection_method = "ocr"
+    
+    # Aplicar si hay ángulo significativo
+    # O si force_table_fix=True y el ángulo no es exactamente 0
+    should_apply = (table_angle is not None and abs(table_angle) > 0.3)
+    if force_table_fix and table_angle is not None and table_angle != 0:
+        should_apply = True
+        logger.info(f"Forcing table fix with angle: {table_angle:.2f}°")
+    
+    if should_apply:
+        fine_rotation = table_angle
+        detection_method = "ocr+deskew" if page_rotation != 0 else "deskew"
+    else:
+        logger.info("No significant skew detected or correction skipped")
+    
+    diagnostics = {
+        "format": original_format,
+        "page_rotation": page_rotation,
+        "fine_rotation": fine_rotation,
+        "detection_method": detection_method,
+    }
+    if page_rotation == 0 and fine_rotation == 0:
+        return None, diagnostics
+    
+    # PASO 3: Aplicar las rotaciones a la imagen original,
+    # que solo se decodifica completa en este caso
+    source.seek(0)
+    image = Image.open(source)
+    if page_rotation != 0:
+        image = image.transpose(PAGE_TRANSPOSE[page_rotation % 360])
+        logger.info(f"Page rotated {page_rotation}°")
+    if fine_rotation != 0:
+        image = image.rotate(fine_rotation, expand=True, fillcolor='white')
+        logger.info(f"Deskew fine rotation applied: {fine_rotation:.2f}°")
+    
+    return image, diagnostics
 
 
 @app.get('/health')
@@ -62,8 +321,10 @@ async def health():
     return {"status": "ok"}
 
 
+# Endpoint síncrono: FastAPI lo ejecuta en su threadpool, así OSD, OpenCV y
+# Pillow no bloquean el event loop mientras se atienden otras peticiones
 @app.post('/fix_rotation')
-async def fix_rotation(
+def fix_rotation(
     file: UploadFile = File(...),
     force_table_fix: bool = False
 ):
@@ -79,85 +340,39 @@ async def fix_rotation(
     start_time = time.time()
     logger.info(f"Processing file: {file.filename}, content_type: {file.content_type}")
     
-    # Leer imagen con límite de tamaño
-    content = await file.read()
-    if len(content) > MAX_UPLOAD_SIZE:
+    # Starlette ya ha volcado la subida en un SpooledTemporaryFile:
+    # se mide y se abre directamente, sin copiarla a memoria
+    upload = file.file
+    upload.seek(0, os.SEEK_END)
+    upload_size = upload.tell()
+    upload.seek(0)
+    if upload_size > MAX_UPLOAD_SIZE:
         raise HTTPException(status_code=413, detail="Image too large")
     
     try:
-        # Abrir imagen
-        image = Image.open(io.BytesIO(content))
-        original_format = image.format or 'PNG'
-        logger.info(f"Image size: {image.size}, format: {original_format}")
-        
-        page_rotation = 0
-        fine_rotation = 0
-        detection_method = "none"
-        
-        # PASO 1: Detectar orientación de página (90°, 180°, 270°) con OCR
-        try:
-            # Redimensionar si es muy grande
-            osd_image = image
-            if max(image.size) > MAX_DIMENSION:
-                ratio = MAX_DIMENSION / max(image.size)
-                new_size = tuple(int(dim * ratio) for dim in image.size)
-                osd_image = image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            osd_start = time.time()
-            osd = pytesseract.image_to_osd(osd_image)
-            osd_time = time.time() - osd_start
-            
-            # Extraer ángulo de rotación de página
-            for line in osd.split('\n'):
-                if 'Rotate:' in line:
-                    page_rotation = -int(line.split(':')[1].strip())
-                    detection_method = "ocr"
-                    break
-            
-            logger.info(f"OCR page rotation: {page_rotation}° in {osd_time:.2f}s")
-            
-            # Aplicar rotación de página si es necesario
-            if page_rotation != 0:
-                image = image.rotate(page_rotation, expand=True, fillcolor='white')
-                logger.info(f"Page rotated {page_rotation}°")
-                
-        except Exception as e:
-            logger.warning(f"OCR detection failed: {str(e)[:100]}")
-        
-        # PASO 2: Detectar inclinación fina con deskew
-        try:
-            image_array = np.array(image.convert('RGB'))
-            table_angle = detect_table_angle(image_array)
-            
-            # Aplicar si hay ángulo significativo
-            # O si force_table_fix=True y el ángulo no es exactamente 0
-            should_apply = (table_angle is not None and abs(table_angle) > 0.3)
-            if force_table_fix and table_angle is not None and table_angle != 0:
-                should_apply = True
-                logger.info(f"Forcing table fix with angle: {table_angle:.2f}°")
-            
-            if should_apply:
-                fine_rotation = table_angle
-                image = image.rotate(fine_rotation, expand=True, fillcolor='white')
-                detection_method = "ocr+deskew" if page_rotation != 0 else "deskew"
-                logger.info(f"Deskew fine rotation applied: {fine_rotation:.2f}°")
-            else:
-                logger.info("No significant skew detected or correction skipped")
-        except Exception as e:
-            logger.warning(f"Deskew detection failed: {str(e)}")
-        
+        image, diagnostics = process_image(upload, force_table_fix)
+        original_format = diagnostics["format"]
+        page_rotation = diagnostics["page_rotation"]
+        fine_rotation = diagnostics["fine_rotation"]
+        detection_method = diagnostics["detection_method"]
         total_rotation = page_rotation + fine_rotation
         
-        # Guardar en memoria con calidad alta
-        output = io.BytesIO()
-        if original_format == 'JPEG':
-            image.save(output, format=original_format, quality=95)
-        else:
-            image.save(output, format=original_format)
-        output.seek(0)
-        
         media_type = f"image/{original_format.lower()}"
-        response_content = output.getvalue()
+        
+        if image is None:
+            # Sin corrección: se devuelve el archivo original, sin recodificar
+            upload.seek(0)
+            response_content = upload.read()
+        else:
+            # Guardar en memoria con calidad alta
+            output = io.BytesIO()
+            if original_format == 'JPEG':
+                image.save(output, format=original_format, quality=95)
+            else:
+                image.save(output, format=original_format)
+            
+            # memoryview sobre el buffer: evita la copia completa de getvalue()
+            response_content = output.getbuffer()
         total_time = time.time() - start_time
         
         logger.info(f"Total: {total_time:.2f}s, {len(response_content)} bytes, "
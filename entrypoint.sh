@@ -1,2 +1,10 @@
 #!/bin/sh
-uvicorn app.main:app --host 0.0.0.0 --port 8000
+# Un proceso por núcleo: cada worker procesa sus peticiones en paralelo con los demás.
+# Por defecto como máximo 4, porque cada worker carga su propio Tesseract.
+if [ -z "$WORKERS" ]; then
+    WORKERS=$(nproc)
+    [ "$WORKERS" -gt 4 ] && WORKERS=4
+fi
+# app.main reparte los núcleos entre los workers con este valor
+export WORKERS
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers "$WORKERS"